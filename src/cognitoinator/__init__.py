@@ -1,15 +1,31 @@
-from logging import getLogger
-from io import StringIO
+from logging import getLogger, DEBUG
 from os import environ, path
 from pathlib import Path
+from boto3 import set_stream_logger
 from boto3.session import Session as botosession
 from botocore.configloader import load_config
 from botocore.session import Session as coresession
 from .providers import CognitoIdentity, TokenFetcher, TokenCache
 
 COGNITO_DEFAULT_SESSION = None
-LOGGER = getLogger()
-LOGGER.setLevel(environ.get("COGNITO_LOG_LEVEL", "INFO"))
+LOGGER = getLogger(__name__)
+
+
+def enable_debug(name: str = "cognitoinator", level=DEBUG):
+    # Logging is left to the consumer unless they explicitly opt in here
+    logger = getLogger(name)
+    if logger.handlers:
+        # Already set up so only adjust levels, adding another handler would duplicate every line
+        logger.setLevel(level)
+        for handler in logger.handlers:
+            handler.setLevel(level)
+    else:
+        set_stream_logger(name=name, level=level)
+
+
+# Only the level is set from the environment, handlers are left to the consumer or enable_debug()
+if "COGNITO_LOG_LEVEL" in environ:
+    LOGGER.setLevel(environ["COGNITO_LOG_LEVEL"])
 
 
 def _get_default_session(**kwargs) -> botosession:
@@ -42,12 +58,9 @@ def Session(**kwargs) -> botosession:
     auth_type = kwargs.get("auth_type") or config.get("auth_type") or "user_srp"
     if auth_type not in ("user_password", "user_srp"): raise ValueError("auth_type must be one of user_password or user_srp")
 
-    # If token_cache file is provided we will use it, otherwise we will use a StringIO object
+    # If token_cache file is provided we will use it, otherwise the provider persists tokens under ~/.aws/cognitoinator
     if token_cache := kwargs.get("token_cache"):
         token_cache = TokenCache(token_cache)
-    else:
-        cache_io = StringIO()
-        token_cache = TokenCache(cache_io)
 
     opts = {
         "config": config,
@@ -73,7 +86,7 @@ def Session(**kwargs) -> botosession:
 
     # Now we set the session so when we get the token's getter properties we
     # retreive from the same cache that the provider is using.
-    session.token_cache = token_cache
+    session.token_cache = auth_client.token_cache
 
     # Now we can fire a call to refresh auth tokens if we need to
     session.refresh_auth = auth_client.refresh_auth
@@ -139,7 +152,7 @@ def refresh_token(self) -> str:
 
 
 @property
-def token_expires(self) -> str:
+def token_expires(self) -> float:
     return self.token_cache.tokens.get("token_expires")
 
 
@@ -1,33 +1,72 @@
 #!/usr/bin/env python3.8
 from copy import deepcopy
-from threading import Thread
-from time import sleep
-from io import (
-    StringIO,
-    TextIOBase
-)
+from functools import lru_cache
+from threading import Lock, Thread
+from time import sleep, time
+from io import TextIOBase
 from typing import (
     Callable,
     Union,
     Optional
 )
-from os import environ
+from os import environ, path
+from hashlib import sha1
 import datetime
 import json
 from logging import getLogger
 from dateutil.tz import tzlocal
-from dateutil.parser import parse
 from boto3 import client
 from botocore import UNSIGNED
 from botocore.config import Config
+from botocore.exceptions import (
+    ClientError,
+    ConnectionError as BotoConnectionError,
+    HTTPClientError
+)
 from botocore.credentials import (
     CredentialProvider,
     RefreshableCredentials
 )
+from botocore.utils import JSONFileCache
 from warrant.aws_srp import AWSSRP
 
-LOGGER = getLogger()
-LOGGER.setLevel(environ.get("COGNITO_LOG_LEVEL", "INFO"))
+LOGGER = getLogger(__name__)
+
+# Seconds before expiry at which cached Cognito tokens are considered stale. The same value is used
+# for reusing IAM credentials and for botocore's advisory refresh so the three can't disagree.
+# Pools with short lived tokens get at most half of the token's lifetime, see CognitoIdentity._refresh_margin
+TOKEN_REFRESH_MARGIN = 300
+# Shortest time TokenFetcher.login_loop will sleep between refreshes
+LOGIN_LOOP_MIN_SLEEP = 5
+# botocore already retries throttling, 5xx and socket errors within each call. On top of that a
+# login gets one more attempt after a connection failure, for network blips that outlast botocore's
+# own retries. Every ClientError is raised as is. The backoff sleeps while holding the refresh lock
+# (and the credentials lock when called from the credentials fetcher) so it is kept short.
+LOGIN_ATTEMPTS = 2
+LOGIN_BACKOFF = 1
+# Where tokens are persisted between processes when no token_cache is given
+TOKEN_CACHE_DIR = path.expanduser(path.join("~", ".aws", "cognitoinator"))
+
+# Building a client is expensive so they are shared between providers, keyed on (service, region, unsigned)
+_CLIENTS = {}
+_CLIENTS_LOCK = Lock()
+
+
+def _get_client(service_name: str, region_name: Optional[str] = None, unsigned: bool = False):
+    key = (service_name, region_name, unsigned)
+    if (res := _CLIENTS.get(key)) is None:
+        with _CLIENTS_LOCK:
+            if (res := _CLIENTS.get(key)) is None:
+                opts = {"config": Config(signature_version=UNSIGNED)} if unsigned else {}
+                res = _CLIENTS[key] = client(service_name, region_name=region_name, **opts)
+    return res
+
+
+class CognitoRefreshableCredentials(RefreshableCredentials):
+    # Cognito id tokens only last an hour so botocore's default 15 minute advisory
+    # window would have us refreshing for a quarter of every token's lifetime
+    _advisory_refresh_timeout = TOKEN_REFRESH_MARGIN
+    _mandatory_refresh_timeout = 2 * 60
 
 
 def raise_for_invalid_auth_flow(flow: str):
@@ -49,6 +88,12 @@ def raise_for_invalid_auth_type(auth_type: str):
 
 
 def get_cognito_config_from_env() -> dict:
+    # Callers add to the config they get back so never hand out the cached dict itself
+    return deepcopy(_read_cognito_config_from_env())
+
+
+@lru_cache(maxsize=1)
+def _read_cognito_config_from_env() -> dict:
     envList = [
         "COGNITO_APP_ID",
         "COGNITO_PASSWORD",
@@ -75,13 +120,18 @@ def get_cognito_config_from_env() -> dict:
             "role_session_name": environ.get("COGNITO_ROLE_SESSION_NAME"),
             "auth_flow": environ.get("COGNITO_AUTH_FLOW", "enhanced"),
             "metadata": json.loads(environ.get("COGNITO_METADATA", "{}")),
-            "role_expiry_time": int(environ.get("COGNITO_ROLE_EXPIRY_TIME", "900"))
+            "role_expiry_time": int(environ.get("COGNITO_ROLE_EXPIRY_TIME", "900")),
+            "prefer_password_auth": environ.get("COGNITO_PREFER_PASSWORD_AUTH", "false")
         }
     else:
         res = {}
     return res
 
 
+# Lets tests, or anything else that changes COGNITO_* vars mid-process, force a re-read
+get_cognito_config_from_env.cache_clear = _read_cognito_config_from_env.cache_clear
+
+
 def get_cognito_config(config: dict) -> dict:
     opt_list = [
         "app_id",
@@ -104,9 +154,15 @@ def get_cognito_config(config: dict) -> dict:
 
 
 class TokenCache:
-    def __init__(self, cache: Union[TextIOBase, str]):
+    def __init__(self, cache: Union[TextIOBase, str, JSONFileCache], key: Optional[str] = None):
         self.cache = cache
-        if (
+        self.key = key
+        if isinstance(self.cache, JSONFileCache):
+            if not self.key:
+                raise ValueError("TokenCache requires a key when using a JSONFileCache")
+            self.json_writer = self.__mapping_writer
+            self.json_loader = self.__mapping_loader
+        elif (
             isinstance(self.cache, TextIOBase)
             and hasattr(self.cache, "seek")
             and hasattr(self.cache, "truncate")
@@ -118,7 +174,10 @@ class TokenCache:
             self.json_writer = self.__file_writer
             self.json_loader = self.__file_loader
         else:
-            raise TypeError("TokenCache expects first argument to be either a filename as a string or a seekable, truncatable file-like object")
+            raise TypeError("TokenCache expects first argument to be either a filename as a string, a JSONFileCache or a seekable, truncatable file-like object")
+
+        # Reads are served from memory, the backing cache is only read once and then written through
+        self._cached_tokens = self.__load_tokens()
 
     def raise_for_file_error(self):
         try:
@@ -128,9 +187,11 @@ class TokenCache:
             raise Exception("TokenCache: Invalid cache file") from e
 
     def cache_tokens(self, tokens: dict):
+        tokens = dict(tokens)
         if isinstance(tokens.get("token_expires"), datetime.datetime):
-            tokens["token_expires"] = str(tokens["token_expires"])
+            tokens["token_expires"] = tokens["token_expires"].timestamp()
 
+        self._cached_tokens = tokens
         self.json_writer(tokens)
 
     def __io_writer(self, data: dict):
@@ -148,6 +209,23 @@ class TokenCache:
         self.cache.seek(0)
         return json.loads(res) or {}
 
+    def __mapping_writer(self, data: dict):
+        try:
+            self.cache[self.key] = data
+        except OSError as e:
+            # e.g. a read-only or missing home directory. Tokens are already held in memory so carry on without disk
+            LOGGER.warning(f"TokenCache: Could not write token cache, keeping tokens in memory only: {e}")
+            self.json_writer = self.__null_writer
+
+    def __null_writer(self, data: dict):
+        pass
+
+    def __mapping_loader(self) -> dict:
+        try:
+            return self.cache[self.key] or {}
+        except (KeyError, OSError):
+            return {}
+
     def __file_writer(self, data: dict):
         with open(self.cache, "w") as f:
             json.dump(data, f)
@@ -156,8 +234,7 @@ class TokenCache:
         with open(self.cache, "r") as f:
             return json.load(f) or {}
 
-    @property
-    def tokens(self) -> dict:
+    def __load_tokens(self) -> dict:
         try:
             tokens = self.json_loader()
         except json.decoder.JSONDecodeError as e:
@@ -168,6 +245,11 @@ class TokenCache:
 
         return tokens
 
+    @property
+    def tokens(self) -> dict:
+        # A copy, so callers changing it can't corrupt our state without writing it through
+        return dict(self._cached_tokens)
+
     def delete_token(self, token: str):
         cur_tokens = self.tokens
         try:
@@ -189,7 +271,7 @@ class TokenFetcher():
         self,
         *,
         auth_type: str = "user_srp",
-        config: dict = {},
+        config: Optional[dict] = None,
         region_name: Optional[str] = None,
         server: bool = False,
         token_cache: Optional[Union[TextIOBase, str]] = None,
@@ -199,10 +281,7 @@ class TokenFetcher():
 
         self.non_blocking = non_blocking
 
-        if token_cache is None:
-            io_obj = StringIO()
-            token_cache = TokenCache(io_obj)
-        else:
+        if token_cache is not None:
             token_cache = TokenCache(token_cache)
 
         self.provider = CognitoIdentity(
@@ -212,8 +291,6 @@ class TokenFetcher():
             token_cache=token_cache
         )
 
-        self.provider.token_cache = token_cache
-
         if non_blocking:
             Thread(target=self.provider.cognito_login, daemon=True)
         else:
@@ -224,12 +301,11 @@ class TokenFetcher():
             self.start_server()
 
     def is_expired(self, expires) -> bool:
-        now = datetime.datetime.now(tzlocal())
-        margin = datetime.timedelta(seconds=30)
-        if not expires:
+        # Anything other than an epoch (e.g. a string left by an older cache) is treated as expired
+        if not isinstance(expires, (int, float)):
             return True
         else:
-            return now > parse(expires) - margin
+            return time() > expires - self.provider._refresh_margin
 
     def fetch(self) -> dict:
         self.provider.cognito_login()
@@ -252,14 +328,16 @@ class TokenFetcher():
         return self.provider.token_cache.tokens["refresh_token"]
 
     @property
-    def expires(self) -> str:
+    def expires(self) -> float:
         return self.provider.token_cache.tokens["token_expires"]
 
     def login_loop(self):
         while True:
-            if self.is_expired(self.provider.token_cache.tokens["token_expires"]):
-                self.provider.cognito_login()
-            sleep(5)
+            # Sleep once until just before the tokens expire instead of polling. The floor stops us
+            # spinning on the IDP if a refresh ever hands back tokens that are already due for renewal
+            if self.provider._expires_epoch:
+                sleep(max(LOGIN_LOOP_MIN_SLEEP, self.provider._expires_epoch - self.provider._refresh_margin - time()))
+            self.provider.cognito_login()
 
     def start_server(self):
         if self.non_blocking:
@@ -271,58 +349,76 @@ class TokenFetcher():
 class CognitoIdentity(CredentialProvider):
     METHOD = 'cognito-identity'
     CANONICAL_NAME = 'customCognitoIdentity'
-    api_credential_expiration = None
-    auth = None
     tz = datetime.datetime.now(tzlocal())
-    STS = None
-    IDP = None
 
     def __init__(
         self,
         *,
         auth_type: str = "user_srp",
-        config: dict = {},
-        token_cache: TokenCache,
+        config: Optional[dict] = None,
+        token_cache: Optional[TokenCache] = None,
         region_name: str = None
     ):
         super().__init__(self)
 
         raise_for_invalid_auth_type(auth_type)
         self.profile_credentials = None
-        self.token_cache = token_cache
-
+        self.api_credential_expiration = None
+        self.auth = None
+        self.STS = None
+        self._refresh_lock = Lock()
+        self._identity_id = None
+        self.credentials = None
+        self._credentials_lock = Lock()
+        self._last_iam_creds = None
+        self._last_iam_expiry = None
+
+        # An explicit config always wins, the environment is only used when none was given
+        config = config or {}
         if config:
-            self.config = get_cognito_config(config)
+            self.config = get_cognito_config(deepcopy(config))
         else:
             self.config = get_cognito_config_from_env()
         self.config["region_name"] = region_name or config.get("region") or environ.get("AWS_DEFAULT_REGION")
+        self._logins_key = f"""cognito-idp.{self.config["region_name"]}.amazonaws.com/{self.config["user_pool_id"]}"""
 
-        self.IDP = client(
-            "cognito-idp",
-            region_name=self.config["region_name"],
-            config=Config(signature_version=UNSIGNED)
-        )
+        # Without an explicit cache we persist tokens to disk so new processes can skip a fresh login
+        if token_cache is None:
+            token_cache = TokenCache(JSONFileCache(working_dir=TOKEN_CACHE_DIR), key=self._token_cache_key())
+        self.token_cache = token_cache
+        expires = self.token_cache.tokens.get("token_expires")
+        self._expires_epoch = expires if isinstance(expires, (int, float)) else None
+        # Replaced with a margin that fits the token's lifetime on every login
+        self._refresh_margin = TOKEN_REFRESH_MARGIN
+
+        auth_type = auth_type or environ.get("COGNITO_AUTH_TYPE", "user_srp")
+        # Values from profiles and env vars are strings so accept those as well as a bool
+        prefer_password_auth = str(self.config.get("prefer_password_auth", False)).lower() in ("true", "1", "yes")
+        if auth_type == "user_srp" and prefer_password_auth:
+            self._auth_func = self._preferred_password_auth
+        elif auth_type == "user_srp":
+            self._auth_func = self._srp_auth
+        elif auth_type == "user_password":
+            self._auth_func = self._password_auth
 
-        self.IDENTITY = client("cognito-identity", region_name=self.config["region_name"])
+        self.IDP = _get_client("cognito-idp", self.config["region_name"], unsigned=True)
+        self.IDENTITY = _get_client("cognito-identity", self.config["region_name"])
 
         if self.config["auth_flow"] == "classic":
-            self.STS = client("sts")
-            self.COGNITO_IDP = client("cognito-idp", region_name=self.config["region_name"])
+            self.STS = _get_client("sts")
+            self.COGNITO_IDP = _get_client("cognito-idp", self.config["region_name"])
 
         if "refresh_token" not in self.token_cache.tokens:
             self.token_cache.set_token("refresh_token", None)
 
-        auth_type = auth_type or environ.get("COGNITO_AUTH_TYPE", "user_srp")
-        if auth_type == "user_srp":
-            self._auth_func = self._srp_auth
-        elif auth_type == "user_password":
-            self._auth_func = self._password_auth
-
     def load(self) -> Union[RefreshableCredentials, None]:
-        if self.config:
+        # botocore will call load() for every session we are inserted into, reuse the credentials we already have
+        if self.credentials is not None:
+            res = self.credentials
+        elif self.config:
             fetcher = self._create_credentials_fetcher()
             credentials = fetcher(time_as_string=False)
-            res = RefreshableCredentials(
+            res = CognitoRefreshableCredentials(
                 credentials["access_key"],
                 credentials["secret_key"],
                 credentials["token"],
@@ -330,10 +426,15 @@ class CognitoIdentity(CredentialProvider):
                 refresh_using=fetcher,
                 method=self.METHOD
             )
+            self.credentials = res
         else:
             res = None
         return res
 
+    def _token_cache_key(self) -> str:
+        ident = ":".join(str(self.config.get(x)) for x in ("user_pool_id", "app_id", "username"))
+        return sha1(ident.encode("utf-8")).hexdigest()
+
     def _login(self) -> dict:
         return self._auth_func()
 
@@ -341,7 +442,25 @@ class CognitoIdentity(CredentialProvider):
         self.cognito_login()
         return self.token_cache.tokens
 
-    def cognito_login(self) -> str:
+    def _is_expiring_soon(self, margin: Optional[float] = None) -> bool:
+        margin = self._refresh_margin if margin is None else margin
+        return (
+            not self._expires_epoch
+            or not self.token_cache.tokens.get("id_token")
+            or time() > self._expires_epoch - margin
+        )
+
+    def cognito_login(self, margin: Optional[float] = None) -> str:
+        # Double checked so that concurrent callers don't all hit the IDP at once
+        if not self._is_expiring_soon(margin):
+            return self.token_cache.tokens["id_token"]
+
+        with self._refresh_lock:
+            if not self._is_expiring_soon(margin):
+                return self.token_cache.tokens["id_token"]
+            return self._cognito_login()
+
+    def _authenticate(self) -> dict:
         if self.token_cache.tokens.get("refresh_token") is not None:  # If we have a refresh token use it
             LOGGER.debug("cognito_login: Found refresh token.")
             auth = self._refresh_auth()
@@ -355,26 +474,44 @@ class CognitoIdentity(CredentialProvider):
             auth = self._login()
             LOGGER.debug("cognito_login: Running fresh login")
 
+        return auth
+
+    def _cognito_login(self) -> str:
+        for attempt in range(LOGIN_ATTEMPTS):
+            try:
+                auth = self._authenticate()
+                break
+            except (BotoConnectionError, HTTPClientError) as e:
+                if attempt + 1 == LOGIN_ATTEMPTS:
+                    raise
+                LOGGER.warning(f"cognito_login: Attempt {attempt + 1} of {LOGIN_ATTEMPTS} failed: {e}")
+                sleep(LOGIN_BACKOFF * 2 ** attempt)
+
         # Get the datetime that the token expires in - 1 minute just to be safe
         diff = auth["ExpiresIn"] - 1
         expires_in = datetime.datetime.now(tzlocal()) + datetime.timedelta(seconds=diff)
 
+        self._expires_epoch = expires_in.timestamp()
+        # A 5 minute token would be stale as soon as it was cached with the full margin
+        self._refresh_margin = min(TOKEN_REFRESH_MARGIN, auth["ExpiresIn"] // 2)
+
         self.token_cache.cache_tokens({
             "id_token": auth["IdToken"],
             "access_token": auth["AccessToken"],
-            "token_expires": str(expires_in),
+            "token_expires": expires_in,
             "refresh_token": auth["RefreshToken"]
         })
 
         return auth["IdToken"]
 
     def _srp_auth(self) -> dict:
+        # Passing our shared client stops AWSSRP from building its own on every login
         srp = AWSSRP(
             username=self.config["username"],
             password=self.config["password"],
             pool_id=self.config["user_pool_id"],
             client_id=self.config["app_id"],
-            pool_region=self.config["region_name"],
+            client=self.IDP
         )
 
         AUTH_PARAMETERS = {
@@ -415,6 +552,17 @@ class CognitoIdentity(CredentialProvider):
         self.auth = auth
         return auth
 
+    def _preferred_password_auth(self) -> dict:
+        # USER_PASSWORD_AUTH takes one round trip instead of two, but only works if the app client allows it
+        try:
+            return self._password_auth()
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidParameterException":
+                raise
+            LOGGER.info(f"USER_PASSWORD_AUTH is not available, falling back to USER_SRP_AUTH: {e}")
+            self._auth_func = self._srp_auth
+            return self._srp_auth()
+
     def _refresh_auth(self) -> dict:
         LOGGER.debug("Refreshing auth")
         AUTH_PARAMETERS = {"REFRESH_TOKEN": self.token_cache.tokens["refresh_token"]}
@@ -436,35 +584,34 @@ class CognitoIdentity(CredentialProvider):
 
     def _create_credentials_fetcher(self) -> Callable:
 
-        def fetch(time_as_string: bool = True) -> dict:
+        def assume_role() -> dict:
             LOGGER.debug("Checking credentials....")
 
-            # Get a new idToken if this one has expired
-            if self.token_cache.tokens.get("id_token") is None or datetime.datetime.now(tzlocal()) > parse(self.token_cache.tokens["token_expires"]):
-                LOGGER.debug("Retreiving new Cognito tokens.")
-                id_token = self.cognito_login()
-            else:
-                id_token = self.token_cache.tokens["id_token"]
+            # Returns the cached idToken without a round trip unless it is about to expire. The id token's
+            # expiry caps the credentials' expiry, so it shares the margin in which we'd refetch them
+            id_token = self.cognito_login()
 
-            try:
-                identityId = self.IDENTITY.get_id(
+            logins = {self._logins_key: id_token}
+
+            # The IdentityId is stable for a user so we only need to look it up once
+            if self._identity_id is None:
+                self._identity_id = self.IDENTITY.get_id(
                     IdentityPoolId=self.config["identity_pool_id"],
-                    Logins={f"""cognito-idp.{self.config["region_name"]}.amazonaws.com/{self.config["user_pool_id"]}""": id_token}
+                    Logins=logins
                 )["IdentityId"]
 
-            except self.IDENTITY.exceptions.NotAuthorizedException as e:
-                LOGGER.info(f"LOGIN ERROR: {e}")
-                self.token_cache.tokens["id_token"] = None
-                fetch()
-
             if self.config["auth_flow"] == "classic":
                 LOGGER.debug("Using classic auth flow....")
-                token = self.IDENTITY.get_open_id_token(
-                    IdentityId=identityId,
-                    Logins={
-                        f"""cognito-idp.{self.config["region_name"]}.amazonaws.com/{self.config["user_pool_id"]}""": self.token_cache.tokens["id_token"]
-                    }
-                )["Token"]
+                try:
+                    token = self.IDENTITY.get_open_id_token(
+                        IdentityId=self._identity_id,
+                        Logins=logins
+                    )["Token"]
+                except self.IDENTITY.exceptions.NotAuthorizedException as e:
+                    # Forget the IdentityId so that the next refresh looks it up again
+                    LOGGER.info(f"LOGIN ERROR: {e}")
+                    self._identity_id = None
+                    raise
 
                 if self.config.get("role_session_name") is None:
                     attributes = self.COGNITO_IDP.get_user(
@@ -488,29 +635,33 @@ class CognitoIdentity(CredentialProvider):
                 credentials["Credentials"]["SecretKey"] = credentials["Credentials"]["SecretAccessKey"]
             else:
                 opts = {
-                    "IdentityId": identityId,
-                    "Logins": {f"""cognito-idp.{self.config["region_name"]}.amazonaws.com/{self.config["user_pool_id"]}""": id_token}
+                    "IdentityId": self._identity_id,
+                    "Logins": logins
                 }
                 if self.config.get("role_arn"):
                     opts["CustomRoleArn"] = self.config.get("role_arn")
 
-                credentials = self.IDENTITY.get_credentials_for_identity(**opts)
+                try:
+                    credentials = self.IDENTITY.get_credentials_for_identity(**opts)
+                except self.IDENTITY.exceptions.NotAuthorizedException as e:
+                    # Forget the IdentityId so that the next refresh looks it up again
+                    LOGGER.info(f"LOGIN ERROR: {e}")
+                    self._identity_id = None
+                    raise
 
             # We want to refresh whenever either the id token or iam is about to expire, whichever comes first
-            if not self.token_cache.tokens.get("token_expires"):
+            if not self._expires_epoch:
                 expire_time = credentials["Credentials"]["Expiration"]
-            elif parse(self.token_cache.tokens["token_expires"]) < credentials["Credentials"]["Expiration"]:
-                expire_time = parse(self.token_cache.tokens["token_expires"])
+            elif self._expires_epoch < credentials["Credentials"]["Expiration"].timestamp():
+                expire_time = datetime.datetime.fromtimestamp(self._expires_epoch, tzlocal())
             else:
                 expire_time = credentials["Credentials"]["Expiration"]
 
-            # When we call load() expiry_time has to be a datetime, when we are called by RefreshableCredentials expiry_time needs
-            # to be a string. I think its ugly myself. Open to suggestions.
             creds = {
                 "access_key": credentials["Credentials"]["AccessKeyId"],
                 "secret_key": credentials["Credentials"]["SecretKey"],
                 "token": credentials["Credentials"]["SessionToken"],
-                "expiry_time": str(expire_time) if time_as_string else expire_time
+                "expiry_time": expire_time
             }
 
             self.profile_credentials = {
@@ -523,4 +674,21 @@ class CognitoIdentity(CredentialProvider):
 
             return creds
 
+        def fetch(time_as_string: bool = True) -> dict:
+            with self._credentials_lock:
+                # Skip Cognito entirely while the credentials we last handed out are still good
+                if not (
+                    self._last_iam_expiry
+                    and (self._last_iam_expiry - datetime.datetime.now(tzlocal())).total_seconds() > self._refresh_margin
+                ):
+                    self._last_iam_creds = assume_role()
+                    self._last_iam_expiry = self._last_iam_creds["expiry_time"]
+                creds = dict(self._last_iam_creds)
+
+            # When we call load() expiry_time has to be a datetime, when we are called by RefreshableCredentials expiry_time needs
+            # to be a string. I think its ugly myself. Open to suggestions.
+            if time_as_string:
+                creds["expiry_time"] = str(creds["expiry_time"])
+            return creds
+
         return fetch